@@ -31,9 +31,14 @@ try:
 except:
     import Queue  # Python 2
 
+import bisect
 import json
+import math
+import mmap
+import os
 import re
 import socket
+import struct
 import syslog
 import threading
 # import datetime
@@ -49,6 +54,20 @@ try:
 except:
     import urllib2
 
+# use a faster json decoder if one is installed
+JSON_DECODERS = {'json': json.loads}
+try:
+    import orjson
+    JSON_DECODERS['orjson'] = orjson.loads
+except ImportError:
+    pass
+try:
+    import ujson
+    JSON_DECODERS['ujson'] = ujson.loads
+except ImportError:
+    pass
+fast_json_loads = JSON_DECODERS.get('orjson', JSON_DECODERS.get('ujson'))
+
 import weewx.drivers
 import weewx.engine
 import weewx.units
@@ -77,6 +96,12 @@ def logdbg(msg):
     logmsg(syslog.LOG_DEBUG, msg)
 
 
+def debug_enabled():
+    """Whether debug messages are wanted, so that expensive ones need not be
+    formatted otherwise"""
+    return DEBUG or getattr(weewx, 'debug', 0)
+
+
 def loginf(msg):
     logmsg(syslog.LOG_INFO, msg)
 
@@ -102,7 +127,9 @@ class NetatmoConfEditor(weewx.drivers.AbstractConfEditor):
 
     # The mode specifies how driver should obtain data.  The 'cloud' mode will
     # retrieve data from the netatmo.com servers.  The 'sniff' mode will parse
-    # packets from the netatmo station on the local network.
+    # packets from the netatmo station on the local network.  The 'shared'
+    # mode will get data from a netatmo poller that is shared by every weewx
+    # instance on this host.
     mode = cloud
 
     # The cloud mode requires credentials:
@@ -110,14 +137,35 @@ class NetatmoConfEditor(weewx.drivers.AbstractConfEditor):
     client_id = INSERT_CLIENT_ID_HERE
     client_secret = INSERT_CLIENT_SECRET_HERE
 
+    # Responses are decoded with orjson or ujson if either is installed.  Set
+    # json_decoder to json, orjson, or ujson to pick one.  With the json
+    # decoder, prune_responses = true keeps only the parts of the station
+    # data that the driver uses, which saves memory but takes longer.
+    # json_decoder = auto
+    # prune_responses = false
+
+    # Keep recent readings in a ring buffer that can be queried with
+    # --query-store.  300000 readings is about 30 days of a typical station.
+    # ring_buffer_file = /var/lib/weewx/netatmo.ring
+    # ring_buffer_size = 300000
+
+    # Also aggregate the public stations in a bounding box, then map the
+    # aggregates in the sensor map, for example
+    #   regionTemp = area.NAPublic.Temperature
+    # public_lat_ne = 48.95
+    # public_lon_ne = 2.50
+    # public_lat_sw = 48.80
+    # public_lon_sw = 2.20
+    # public_tile_size = 0.1
+
     # The driver itself
     driver = user.netatmo
 """
 
     def prompt_for_settings(self):
         settings = dict()
-        print("Specify the mode for obtaining data, either 'cloud' or 'sniff'")
-        settings['mode'] = self._prompt('mode', 'cloud', ['cloud', 'sniff'])
+        print("Specify the mode for obtaining data, either 'cloud', 'sniff', or 'shared'")
+        settings['mode'] = self._prompt('mode', 'cloud', ['cloud', 'sniff', 'shared'])
         if settings['mode'] == 'cloud':
             print("Specify the client id for netatmo.com")
             self._prompt('client_id')
@@ -125,6 +173,10 @@ class NetatmoConfEditor(weewx.drivers.AbstractConfEditor):
             self._prompt('client_secret')
             print("Specify the tokens persistence file")
             self._prompt('tokens_persistence_file')
+        elif settings['mode'] == 'shared':
+            print("Specify the socket of the shared poller")
+            settings['socket_path'] = self._prompt(
+                'socket_path', SharedPoller.DEFAULT_SOCKET)
         return settings
 
 
@@ -170,6 +222,21 @@ class NetatmoDriver(weewx.drivers.AbstractDevice):
         if 'sensor_map' in stn_dict:
             self.sensor_map.update(stn_dict['sensor_map'])
         loginf('sensor map is %s' % self.sensor_map)
+        # per station state, the (layout, slots) for each database field and
+        # the last generation that was emitted
+        self._resolved = dict()
+        self._last_generation = dict()
+        self.public_collector = None
+        self.store = None
+        if stn_dict.get('ring_buffer_file'):
+            self.store = ReadingStore(
+                stn_dict['ring_buffer_file'],
+                capacity=int(stn_dict.get('ring_buffer_size', 300000)))
+        # what the collectors extract: the sensor map, plus everything the
+        # ring buffer stores
+        tracked = dict(self.sensor_map)
+        if self.store:
+            tracked.update(ReadingStore.TRACKED)
         device_id = stn_dict.get('device_id', None)
         mode = stn_dict.get('mode', 'cloud')
         if mode.lower() == 'sniff':
@@ -185,16 +252,49 @@ class NetatmoDriver(weewx.drivers.AbstractDevice):
             client_secret = stn_dict['client_secret']
             gm_device_id = stn_dict.get('gm_device_id', None)
             gm_node_id = stn_dict.get('gm_node_id', None)
+            # 'auto' uses a faster json decoder if one is installed
+            loads = CloudClient.ResponseDecoder.loads_for(
+                stn_dict.get('json_decoder', 'auto'))
+            keep = None
+            if weeutil.weeutil.tobool(stn_dict.get('prune_responses', False)):
+                keep = CloudClient.STATIONS_KEYS
             self.collector = CloudClient(
                 tokens_persistence_file, client_id, client_secret,
                 device_id=device_id, poll_interval=poll_interval,
-                max_tries=max_tries, retry_wait=retry_wait)
+                max_tries=max_tries, retry_wait=retry_wait,
+                sensor_map=tracked,
+                decoder=CloudClient.ResponseDecoder(loads, keep))
+            if 'public_lat_ne' in stn_dict:
+                # share the auth so there is only one refresh token user
+                self.public_collector = PublicDataClient(
+                    self.collector.auth,
+                    float(stn_dict['public_lat_ne']),
+                    float(stn_dict['public_lon_ne']),
+                    float(stn_dict['public_lat_sw']),
+                    float(stn_dict['public_lon_sw']),
+                    tile_size=float(stn_dict.get('public_tile_size', 0.1)),
+                    threads=int(stn_dict.get('public_threads', 4)),
+                    poll_interval=int(stn_dict.get('public_poll_interval', 600)),
+                    max_tries=max_tries, retry_wait=retry_wait,
+                    sensor_map=tracked)
+        elif mode.lower() == 'shared':
+            retry_wait = int(stn_dict.get('retry_wait', 10))  # seconds
+            socket_path = stn_dict.get('socket_path',
+                                       SharedPoller.DEFAULT_SOCKET)
+            self.collector = SharedClient(socket_path, retry_wait=retry_wait,
+                                          sensor_map=tracked)
         else:
             raise ValueError("unsupported mode '%s'" % mode)
         self.collector.startup()
+        if self.public_collector:
+            self.public_collector.startup()
 
     def closePort(self):
         self.collector.shutdown()
+        if self.public_collector:
+            self.public_collector.shutdown()
+        if self.store:
+            self.store.close()
 
     @property
     def hardware_name(self):
@@ -203,40 +303,230 @@ class NetatmoDriver(weewx.drivers.AbstractDevice):
     def genLoopPackets(self):
         while True:
             try:
-                data = self.collector.queue.get(True, 10)
-                logdbg('data: %s' % data)
-                pkt = self.data_to_packet(data)
+                state = self.collector.queue.get(True, 10)
+                if state.generation == self._last_generation.get(state):
+                    continue  # already emitted these readings
+                pkt = self.data_to_packet(state)
                 logdbg('packet: %s' % pkt)
+                if self.store:
+                    with state.lock:
+                        self.store.append_state(state)
                 if pkt:
                     yield pkt
             except Queue.Empty:
                 pass
 
-    def data_to_packet(self, data):
+    def data_to_packet(self, state):
         # convert netatmo data to format for database
         packet = dict()
         packet['dateTime'] = int(time.time() + 0.5)
         packet['usUnits'] = weewx.METRIC
-        for n in self.sensor_map:
-            label = self._find_match(self.sensor_map[n], list(data.keys()))
-            if label:
-                packet[n] = data.get(label)
+        with state.lock:
+            layout, resolved = self._resolved.get(state, (None, None))
+            if state.layout != layout:
+                # modules came or went, so figure out again which slot
+                # provides each database field
+                resolved = [(n, state.find(self.sensor_map[n]))
+                            for n in self.sensor_map]
+                self._resolved[state] = (state.layout, resolved)
+            for n, matches in resolved:
+                for rec, idx in matches:
+                    if rec.values[idx] is not None:
+                        packet[n] = rec.values[idx]
+                        break
+            self._last_generation[state] = state.generation
+        if debug_enabled():
+            logdbg('data: %s' % state)
         return packet
 
-    @staticmethod
-    def _find_match(pattern, keylist):
+
+class StationState(object):
+    """The latest readings from every device and module on the account.
+
+    Each device or module is a Record with a fixed set of value slots that
+    depends on its type.  The records are created the first time a module is
+    seen, then updated in place on every poll, so the steady state of a poll
+    allocates no per-module dicts or fully-qualified string keys.
+
+    The generation is bumped on every update so that a consumer can tell
+    whether it has already seen the current readings.  The layout is bumped
+    whenever records are added or removed so that a consumer can cache any
+    lookups into the records.
+
+    If a sensor map is given, only the devices, modules, and fields that the
+    map refers to are tracked.  Anything else is never extracted at all.
+    """
+
+    # values that are tracked for every device and module
+    COMMON_FIELDS = ('time_utc',)
+
+    # dashboard values reported by each type of device or module.  unknown
+    # types get every dashboard item.
+    TYPE_FIELDS = {
+        'NAMain': ('Temperature', 'Humidity', 'AbsolutePressure', 'Pressure',
+                   'CO2', 'Noise'),
+        'NAModule1': ('Temperature', 'Humidity'),
+        'NAModule2': ('WindStrength', 'WindAngle', 'GustStrength',
+                      'GustAngle'),
+        'NAModule3': ('Rain', 'sum_rain_24', 'sum_rain_1'),
+        'NAModule4': ('Temperature', 'Humidity', 'CO2'),
+        # aggregates of public stations, see PublicDataClient
+        'NAPublic': ('stations',
+                     'Temperature', 'Temperature_min', 'Temperature_max',
+                     'Humidity', 'Humidity_min', 'Humidity_max',
+                     'Pressure', 'Pressure_min', 'Pressure_max',
+                     'Rain', 'Rain_min', 'Rain_max',
+                     'sum_rain_1', 'sum_rain_1_min', 'sum_rain_1_max',
+                     'sum_rain_24', 'sum_rain_24_min', 'sum_rain_24_max',
+                     'WindStrength', 'WindStrength_min', 'WindStrength_max',
+                     'WindAngle',
+                     'GustStrength', 'GustStrength_min', 'GustStrength_max',
+                     'GustAngle')}
+
+    class Record(object):
+        __slots__ = ('id', 'type', 'fields', 'slots', 'values', 'generation')
+
+        def __init__(self, xid, xtype, fields, slots):
+            self.id = xid
+            self.type = xtype
+            self.fields = fields
+            self.slots = slots
+            self.values = [None] * len(fields)
+            self.generation = 0
+
+        def get(self, name, default=None):
+            idx = self.slots.get(name)
+            if idx is None:
+                return default
+            value = self.values[idx]
+            return default if value is None else value
+
+        def set(self, name, value):
+            idx = self.slots.get(name)
+            if idx is not None:
+                self.values[idx] = value
+
+        def clear(self):
+            for i in range(len(self.values)):
+                self.values[i] = None
+
+        def items(self):
+            for i, name in enumerate(self.fields):
+                if self.values[i] is not None:
+                    yield name, self.values[i]
+
+    def __init__(self, sensor_map=None):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.layout = 0
+        self._records = []  # records in the order they were first seen
+        self._index = dict()  # (id, type) to record
+        self._layouts = dict()  # type to (fields, slots), shared by records
+        self._wanted = dict()  # (id, type) to whether it is tracked
+        self._patterns = None  # split sensor map patterns, None for all
+        if sensor_map is not None:
+            self._patterns = [x for x in
+                              set(tuple(v.split('.'))
+                                  for v in sensor_map.values())
+                              if len(x) == 3]
+
+    @property
+    def records(self):
+        return self._records
+
+    def wants(self, xid, xtype):
+        """Whether the sensor map refers to anything from this device or
+        module"""
+        if self._patterns is None:
+            return True
+        key = (xid, xtype)
+        if key not in self._wanted:
+            self._wanted[key] = any(
+                StationState._part_match(p[0], xid) and
+                StationState._part_match(p[1], xtype)
+                for p in self._patterns)
+        return self._wanted[key]
+
+    def fields_for(self, xtype):
+        if xtype not in self._layouts:
+            fields = (tuple(CloudClient.META_ITEMS) +
+                      StationState.TYPE_FIELDS.get(
+                          xtype, tuple(CloudClient.DASHBOARD_ITEMS)))
+            if self._patterns is not None:
+                fields = tuple(
+                    n for n in fields
+                    if any(StationState._part_match(p[1], xtype) and
+                           StationState._part_match(p[2], n)
+                           for p in self._patterns))
+            fields = StationState.COMMON_FIELDS + fields
+            slots = dict((n, i) for i, n in enumerate(fields))
+            self._layouts[xtype] = (fields, slots)
+        return self._layouts[xtype]
+
+    def begin_update(self):
+        """Start a new generation.  Call with the lock held."""
+        self.generation += 1
+
+    def record(self, xid, xtype):
+        """Return the record for a device or module, creating it if this is
+        the first time it has been seen, and mark it as current.  Return
+        None if the device or module is not tracked."""
+        rec = self._index.get((xid, xtype))
+        if rec is None:
+            if not self.wants(xid, xtype):
+                return None
+            fields, slots = self.fields_for(xtype)
+            rec = StationState.Record(xid, xtype, fields, slots)
+            self._index[(xid, xtype)] = rec
+            self._records.append(rec)
+            self.layout += 1
+        rec.generation = self.generation
+        return rec
+
+    def end_update(self):
+        """Drop any records that were not seen in the current generation.
+        Call with the lock held."""
+        stale = [r for r in self._records if r.generation != self.generation]
+        if stale:
+            for rec in stale:
+                del self._index[(rec.id, rec.type)]
+            self._records = [r for r in self._records
+                             if r.generation == self.generation]
+            self.layout += 1
+
+    def snapshot(self):
+        """Return the current readings as a list of [id, type, values] that
+        can be serialized.  Call with the lock held."""
+        return [[r.id, r.type, dict(r.items())] for r in self._records]
+
+    def load(self, snapshot):
+        """Replace the current readings with those from a snapshot,
+        updating the records in place."""
+        with self.lock:
+            self.begin_update()
+            for xid, xtype, values in snapshot:
+                rec = self.record(xid, xtype)
+                if rec is None:
+                    continue
+                rec.clear()
+                for n in values:
+                    rec.set(n, values[n])
+            self.end_update()
+
+    def find(self, pattern):
+        """Return a list of (record, slot) for every value that matches a
+        sensor map pattern of the form <id>.<type>.<field>"""
         pparts = pattern.split('.')
         if len(pparts) != 3:
-            return None
-        for k in keylist:
-            kparts = k.split('.')
-            if len(kparts) != 3:
-                return None
-            if (NetatmoDriver._part_match(pparts[0], kparts[0]) and
-                    NetatmoDriver._part_match(pparts[1], kparts[1]) and
-                    NetatmoDriver._part_match(pparts[2], kparts[2])):
-                return k
-        return None
+            return []
+        matches = []
+        for rec in self._records:
+            if (StationState._part_match(pparts[0], rec.id) and
+                    StationState._part_match(pparts[1], rec.type)):
+                for i, name in enumerate(rec.fields):
+                    if StationState._part_match(pparts[2], name):
+                        matches.append((rec, i))
+        return matches
 
     @staticmethod
     def _part_match(pattern, value):
@@ -246,6 +536,10 @@ class NetatmoDriver(weewx.drivers.AbstractDevice):
             return True
         return False
 
+    def __str__(self):
+        return ', '.join("%s.%s.%s: %s" % (r.id, r.type, n, v)
+                         for r in self._records for n, v in r.items())
+
 
 class Collector(object):
     queue = Queue.Queue()
@@ -288,6 +582,7 @@ class CloudClient(Collector):
     AUTH_URL = '/oauth2/token'
     DATA_URL = '/api/getstationsdata'
     GETM_URL = '/api/getmeasure'
+    PUBLIC_URL = '/api/getpublicdata'
 
     # mapping between observation name and function used to convert it
     CONVERSIONS = {
@@ -318,19 +613,31 @@ class CloudClient(Collector):
         'battery_percent',
         'firmware', 'last_setup', 'last_upgrade', 'date_setup']
 
+    # how long to use the device filter learned from the sensor map before
+    # looking at every device on the account again
+    DEVICE_FILTER_LIFETIME = 86400  # seconds
+
     def __init__(self, tokens_persistence_file, client_id, client_secret,
-                 device_id=None, poll_interval=300, max_tries=3, retry_wait=30):
+                 device_id=None, poll_interval=300, max_tries=3, retry_wait=30,
+                 sensor_map=None, decoder=None):
         self._poll_interval = poll_interval
         self._max_tries = max_tries
         self._retry_wait = retry_wait
         self._device_id = device_id
         self._auth = CloudClient.GrantTypeAuth(
             tokens_persistence_file, client_id, client_secret)
-        self._sd = CloudClient.StationData(self._auth)
+        self._sd = CloudClient.StationData(self._auth, decoder=decoder)
         self._gm = CloudClient.StationMeasure(self._auth)
         self._thread = None
         self._collect_data = False
         self._gm_info = {}
+        self._state = StationState(sensor_map)
+        self._device_filter = None
+        self._device_filter_expiry = 0
+
+    @property
+    def auth(self):
+        return self._auth
 
     def collect_data(self):
         """Loop forever, wake up periodically to see if it is time to quit."""
@@ -338,9 +645,18 @@ class CloudClient(Collector):
         while self._collect_data:
             now = int(time.time())
             if now - last_poll > self._poll_interval:
+                if self._device_filter_expiry < now:
+                    self._device_filter = None
                 for tries in range(self._max_tries):
                     try:
-                        CloudClient.get_data(self._sd, self._gm, self._device_id, self._gm_info)
+                        device_id = self._device_id or self._device_filter
+                        devices = CloudClient.get_data(self._sd, self._gm, device_id, self._gm_info, self._state)
+                        if device_id is None and len(devices) == 1:
+                            # everything we need is on one device, so only
+                            # ask for that one
+                            logdbg('only querying device %s' % devices[0])
+                            self._device_filter = devices[0]
+                            self._device_filter_expiry = now + CloudClient.DEVICE_FILTER_LIFETIME
                         break
                     except (socket.error, socket.timeout,
                             urllib.error.HTTPError if pvers == 3 else urllib2.HTTPError,
@@ -361,39 +677,34 @@ class CloudClient(Collector):
             time.sleep(1)
 
     @staticmethod
-    def get_data(sd, gm, device_id, gm_info):
-        """Query the server for each device and module, put data on queue"""
+    def get_data(sd, gm, device_id, gm_info, state):
+        """Query the server for each device and module, update the station
+        state in place, then put the state on the queue.  Return the ids of
+        the devices that have anything the state tracks."""
         raw_data = sd.get_data(device_id)
         units_dict = dict((x, raw_data['user']['administrative'][x])
                           for x in CloudClient.UNITS)
         logdbg('cloud units: %s' % units_dict)
-        # i would prefer to do partial packets, but there is no guarantee that
-        # the timestamps will not align.  so aggregate into a single packet,
-        # and let the driver figure out what timestamp it wants to put on it.
-        alldata = dict()  # single dict with all devices and modules
+        # find the rain modules before touching the state, so that the rain
+        # correction can go into the same update as everything else.
+        rain_fields = state.fields_for('NAModule3')[1]
+        duplicates = set()  # rain modules whose reading was already posted
         for d in raw_data['devices']:
-            data = CloudClient.extract_data(d, units_dict)
-            data = CloudClient.apply_labels(data, d['_id'], d['type'])
-            alldata.update(data)
-            # Collector.queue.put(data)
             for m in d['modules']:
-                data = CloudClient.extract_data(m, units_dict)
-                if m['type'] == 'NAModule3' and data.get('time_utc', None):
+                actrain = m.get('dashboard_data', {}).get('time_utc')  # actual time of measurement
+                if (m['type'] == 'NAModule3' and 'Rain' in rain_fields and actrain and
+                        state.wants(m['_id'], m['type'])):
                     # is it rain Module and was the time returned?
                     curr_station = d['_id']
                     if not curr_station in gm_info:
                         gm_info[curr_station] = {'module': m['_id'], 'type': m['type'], 'lastp': 0, 'lasta': 0}
                         print('Found Rain Module %s for correction' % gm_info[curr_station]['module'])
-                    actrain = data['time_utc']  # actual time of measurement
                     if gm_info[curr_station]['lastp'] == actrain:  # remove rain data if already posted
-                        data['Rain'] = 0.0  # data already written, reset/set to zero
-                        logdbg('Duplicate detected. Modified rain to 0.0')
+                        duplicates.add(m['_id'])
                     gm_info[curr_station]['lastp'] = actrain  # save last posted raindata time
-                data = CloudClient.apply_labels(data, m['_id'], m['type'])
-                alldata.update(data)
 
-        # Collector.queue.put(alldata)
         """Query the server for rain data with getmeasurement."""
+        corrections = dict()  # rain module to additional rain in cm
         for station in gm_info:
             rain_data = gm.get_data(station, gm_info[station]['module'])
             logdbg('getmeasurement Resp: %s' % rain_data)
@@ -407,50 +718,67 @@ class CloudClient(Collector):
                     else:  # no, prepare for adding rain amount
                         # Rain Data is statically converted from mm -> cm (as WEEWX needs it) by multiplying with 0.1
                         # add the additional rain data to the entry "Rain" in collected data
-                        rainindex = gm_info[station]['module'] + "." + gm_info[station]['type'] + ".Rain"
-                        logdbg('Modified rain data for %s' % rainindex)
-                        alldata[rainindex] += (rain_data[str(rain_data_times[1])][0]) * 0.1
+                        corrections[gm_info[station]['module']] = (rain_data[str(rain_data_times[1])][0]) * 0.1
                         gm_info[station]['lasta'] = rain_data_times[1]  # save last written date
             else:
                 print("Lacking data for rain fix. Skipping.")
-        logdbg('Alldata: %s' % alldata)
-        Collector.queue.put(alldata)  # now write the modified record
+
+        # i would prefer to do partial packets, but there is no guarantee that
+        # the timestamps will not align.  so aggregate into a single state,
+        # and let the driver figure out what timestamp it wants to put on it.
+        devices = []
+        with state.lock:
+            state.begin_update()
+            for d in raw_data['devices']:
+                rec = state.record(d['_id'], d['type'])
+                if rec is not None:
+                    CloudClient.extract_data(d, units_dict, rec)
+                    devices.append(d['_id'])
+                for m in d['modules']:
+                    rec = state.record(m['_id'], m['type'])
+                    if rec is None:
+                        continue
+                    CloudClient.extract_data(m, units_dict, rec)
+                    if d['_id'] not in devices:
+                        devices.append(d['_id'])
+                    if m['_id'] in duplicates:
+                        rec.set('Rain', 0.0)  # data already written, reset/set to zero
+                        logdbg('Duplicate detected. Modified rain to 0.0')
+                    if m['_id'] in corrections:
+                        logdbg('Modified rain data for %s.%s.Rain' % (rec.id, rec.type))
+                        rec.set('Rain', rec.get('Rain', 0.0) + corrections[m['_id']])
+            state.end_update()
+        if debug_enabled():
+            logdbg('State: %s' % state)
+        Collector.queue.put(state)  # now write the modified record
+        return devices
 
     @staticmethod
-    def extract_data(x, units_dict):
-        """Extract data we care about from a device or module"""
-        data = dict()
+    def extract_data(x, units_dict, rec):
+        """Extract data we care about from a device or module into its
+        record"""
+        rec.clear()
         # if contact with sensors is lost, then there will be no dashboard_data
         if 'dashboard_data' not in x:
-            return data
-        if 'time_utc' in x['dashboard_data']:
-            data['time_utc'] = x['dashboard_data']['time_utc']
-        for n in CloudClient.META_ITEMS:
+            return rec
+        dashboard = x['dashboard_data']
+        for i, n in enumerate(rec.fields):
             if n in x:
-                data[n] = x[n]
-        for n in CloudClient.DASHBOARD_ITEMS:
-            if n in x['dashboard_data']:
-                data[n] = x['dashboard_data'][n]
-        # do any unit conversions - everything converts to weewx.METRIC
-        for n in data:
+                value = x[n]
+            elif n in dashboard:
+                value = dashboard[n]
+            else:
+                continue
+            # do any unit conversions - everything converts to weewx.METRIC
             if n in CloudClient.CONVERSIONS:
                 try:
                     func = CloudClient.CONVERSIONS.get(n)
-                    data[n] = getattr(CloudClient, func)(data[n], units_dict)
+                    value = getattr(CloudClient, func)(value, units_dict)
                 except ValueError as e:
-                    logerr("unit conversion failed for %s: %s" % (data[n], e))
-                    data[n] = None
-        return data
-
-    @staticmethod
-    def apply_labels(data, xid, xtype):
-        """Copy the data dict but use fully-qualified keys"""
-        return dict(("%s.%s.%s" % (xid, xtype, n), data[n]) for n in data)
-
-    #        new_data = dict()
-    #        for n in data:
-    #            new_data["%s.%s.%s" % (xid, xtype, n)] = data[n]
-    #        return new_data
+                    logerr("unit conversion failed for %s: %s" % (value, e))
+                    value = None
+            rec.values[i] = value
+        return rec
 
     @staticmethod
     def _cvt_pressure(x, from_unit_dict):
@@ -524,6 +852,12 @@ class CloudClient(Collector):
             self._access_token = None
             self._scope = None
             self._expiration = None
+            # the refresh token changes on every refresh, so only one thread
+            # at a time may do it
+            self._lock = threading.Lock()
+            # every request made with these tokens counts against the same
+            # per-user limits, so they all wait on this
+            self.limiter = RateLimiter(RateLimiter.NETATMO_LIMITS)
 
         @property
         def refresh_token(self):
@@ -556,21 +890,24 @@ class CloudClient(Collector):
 
         @property
         def access_token(self):
-            if self._expiration is None or self._expiration < time.time():
-                params = {
-                    'grant_type': 'refresh_token',
-                    'refresh_token': self.refresh_token,
-                    'client_id': self._client_id,
-                    'client_secret': self._client_secret}
-                resp = CloudClient.post_request(CloudClient.AUTH_URL, params)
-                self._access_token = resp['access_token']
-                self.refresh_token = resp['refresh_token']
-                self._expiration = int(resp['expire_in'] + time.time())
-            return self._access_token
+            with self._lock:
+                if self._expiration is None or self._expiration < time.time():
+                    params = {
+                        'grant_type': 'refresh_token',
+                        'refresh_token': self.refresh_token,
+                        'client_id': self._client_id,
+                        'client_secret': self._client_secret}
+                    self.limiter.wait()
+                    resp = CloudClient.post_request(CloudClient.AUTH_URL, params)
+                    self._access_token = resp['access_token']
+                    self.refresh_token = resp['refresh_token']
+                    self._expiration = int(resp['expire_in'] + time.time())
+                return self._access_token
 
     class StationData(object):
-        def __init__(self, auth):
+        def __init__(self, auth, decoder=None):
             self._auth = auth
+            self._decoder = decoder
             self._last_update = 0
             self._raw_data = dict()
 
@@ -580,8 +917,10 @@ class CloudClient(Collector):
                 headers = {"Authorization": "Bearer " + self._auth.access_token}
                 if device_id:
                     params['device_id'] = device_id
-                resp = CloudClient.post_request(CloudClient.DATA_URL, params, headers=headers)
-                self._raw_data = dict(resp['body'])
+                self._auth.limiter.wait()
+                resp = CloudClient.post_request(CloudClient.DATA_URL, params, headers=headers,
+                                                decoder=self._decoder)
+                self._raw_data = resp['body']
                 self._last_update = int(time.time())
             return self._raw_data
 
@@ -607,14 +946,75 @@ class CloudClient(Collector):
                 #  "&limit=" + limit +
                 params['optimize'] = 'false'
                 params['real_time'] = 'true'
+                self._auth.limiter.wait()
                 resp = CloudClient.post_request(CloudClient.GETM_URL, params)
-                self._raw_data = dict(resp['body'])
+                # the body is an empty list rather than a dict when there is
+                # no data
+                self._raw_data = resp['body'] or dict()
                 self._last_update = int(time.time())
             return self._raw_data
 
+    class ResponseDecoder(object):
+        """Decode the json of an api response.
+
+        The loads function defaults to the fastest decoder that is
+        installed.  If keep is specified and the decoder is the stdlib one,
+        then any object member whose name is not in keep is dropped while
+        decoding, at any depth, so it is never built.  That lowers the peak
+        memory at the cost of some decode time.  Other decoders cannot prune
+        while decoding, and pruning after would cost more than it saves, so
+        keep is ignored for them."""
+
+        def __init__(self, loads=None, keep=None):
+            if loads is None:
+                loads = fast_json_loads or json.loads
+            if keep is not None and loads is not json.loads:
+                loginf("responses are only pruned with the json decoder")
+                keep = None
+            self._loads = loads
+            self._keep = keep
+            self._hook = self._prune_pairs if keep is not None else None
+
+        @staticmethod
+        def loads_for(name):
+            """Return the loads function for a json_decoder setting, or None
+            for auto"""
+            if name == 'auto':
+                return None
+            if name not in JSON_DECODERS:
+                raise ValueError("json_decoder '%s' is not installed or not "
+                                 "one of auto, %s" %
+                                 (name, ', '.join(sorted(JSON_DECODERS))))
+            return JSON_DECODERS[name]
+
+        @property
+        def name(self):
+            return "%s%s" % (getattr(self._loads, '__module__', None) or
+                             repr(self._loads),
+                             ' (pruned)' if self._keep is not None else '')
+
+        def decode(self, raw):
+            if self._hook is not None:
+                if isinstance(raw, bytes):
+                    raw = raw.decode('utf-8')
+                return self._loads(raw, object_pairs_hook=self._hook)
+            return self._loads(raw)
+
+        def _prune_pairs(self, pairs):
+            keep = self._keep
+            return dict(p for p in pairs if p[0] in keep)
+
+    # every member of a getstationsdata response that get_data or
+    # extract_data uses, at any depth
+    STATIONS_KEYS = frozenset(
+        ['status', 'error', 'code', 'message', 'body', 'devices', 'modules',
+         'type', 'dashboard_data', 'time_utc', 'user', 'administrative'] +
+        UNITS + META_ITEMS + DASHBOARD_ITEMS)
+    DECODER = ResponseDecoder()
+
     @staticmethod
-    def post_request(url, params, headers=None):
-        # netatmo response body size is limited to 64K
+    def post_request(url, params, headers=None, decoder=None, max_size=65535):
+        # netatmo response body size is limited to 64K, except for public data
         url = CloudClient.NETATMO_URL + url
         params = urlencode(params).encode("utf-8")
         if headers is None:
@@ -624,13 +1024,355 @@ class CloudClient(Collector):
         logdbg("url: %s data: %s hdr: %s" % (url, params, headers))
         req = urllib.request.Request(url=url, data=params, headers=headers) if pvers == 3 else \
             urllib2.Request(url=url, data=params, headers=headers)
-        resp = urllib.request.urlopen(req).read(65535) if pvers == 3 else \
-            urllib2.urlopen(req).read(65535)
-        resp_obj = json.loads(resp)
+        resp = urllib.request.urlopen(req) if pvers == 3 else \
+            urllib2.urlopen(req)
+        resp = resp.read(max_size) if max_size else resp.read()
+        if decoder is None:
+            decoder = CloudClient.DECODER
+        resp_obj = decoder.decode(resp)
         logdbg("resp_obj: %s" % resp_obj)
         return resp_obj
 
 
+class ReadingStore(object):
+    """A fixed-size ring buffer of readings in a memory-mapped file.
+
+    Every reading is a timestamp, a channel, and a value, where a channel is
+    a fully-qualified <id>.<type>.<field> name.  The readings are kept as
+    three arrays in the file so that a reading is a fixed 18 bytes and the
+    file never grows.  The channel names are kept in <filename>.channels.
+    Once the buffer is full the oldest readings are overwritten.
+
+    The file can be opened read-only by another process to query it while
+    the driver is appending to it.
+    """
+
+    MAGIC = b'NARING02'
+    # magic, capacity, index of the next write, number of readings
+    _HEADER = struct.Struct('<8sIII')
+    _HEADER_SIZE = 32
+    _VALUE = struct.Struct('<d')
+    _TIME = struct.Struct('<q')
+    _CHANNEL = struct.Struct('<H')
+    RECORD_SIZE = 18  # value, time, and channel
+    # readings are appended in poll order, but modules report at different
+    # times, so keep scanning back this far past the start of a window
+    SLACK = 3600  # seconds
+    # values that are worth keeping a history of
+    FIELDS = set(CloudClient.DASHBOARD_ITEMS +
+                 ['wifi_status', 'rf_status', 'battery_vp', 'battery_percent'])
+    # sensor map patterns that make a station state track every field that
+    # is stored, whether or not the driver's sensor map uses it
+    TRACKED = dict(('store.%s' % x, '*.*.%s' % x) for x in FIELDS)
+
+    def __init__(self, filename, capacity=300000, read_only=False):
+        self._filename = filename
+        self._channels_file = filename + '.channels'
+        self._read_only = read_only
+        if not os.path.exists(filename):
+            if read_only:
+                raise IOError("no such reading store: %s" % filename)
+            # write every block now, since running out of disk on a page
+            # of a sparse file that is mapped would kill the process
+            tmp = filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(ReadingStore._HEADER.pack(
+                    ReadingStore.MAGIC, capacity, 0, 0))
+                f.write(b'\0' * (ReadingStore._HEADER_SIZE -
+                                 ReadingStore._HEADER.size))
+                remaining = ReadingStore.RECORD_SIZE * capacity
+                while remaining > 0:
+                    chunk = min(remaining, 1 << 20)
+                    f.write(b'\0' * chunk)
+                    remaining -= chunk
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, filename)
+        self._file = open(filename, 'rb' if read_only else 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ
+                             if read_only else mmap.ACCESS_WRITE)
+        magic, self._capacity, _, _ = ReadingStore._HEADER.unpack_from(
+            self._mm, 0)
+        if magic != ReadingStore.MAGIC:
+            raise IOError("%s is not a reading store" % filename)
+        if self._capacity != capacity and not read_only:
+            loginf("reading store %s keeps its capacity of %d readings" %
+                   (filename, self._capacity))
+        self._times_at = ReadingStore._HEADER_SIZE + 8 * self._capacity
+        self._channels_at = self._times_at + 8 * self._capacity
+        self._names = []
+        self._ids = dict()
+        self._load_channels()
+        self._last_seen = dict()  # (id, type) to time_utc last appended
+        if not read_only:
+            for name, (ts, _) in self.latest('*.*.*').items():
+                xid, xtype, _ = name.rsplit('.', 2)
+                key = (xid, xtype)
+                self._last_seen[key] = max(ts, self._last_seen.get(key, ts))
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def _load_channels(self):
+        if os.path.exists(self._channels_file):
+            with open(self._channels_file, 'r') as f:
+                self._names = json.load(f)
+            self._ids = dict((n, i) for i, n in enumerate(self._names))
+
+    def _channel_id(self, name):
+        idx = self._ids.get(name)
+        if idx is None:
+            idx = len(self._names)
+            self._names.append(name)
+            self._ids[name] = idx
+            tmp = self._channels_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._names, f)
+            os.rename(tmp, self._channels_file)
+        return idx
+
+    def append(self, ts, name, value):
+        _, capacity, head, count = ReadingStore._HEADER.unpack_from(self._mm, 0)
+        ReadingStore._VALUE.pack_into(
+            self._mm, ReadingStore._HEADER_SIZE + 8 * head, value)
+        ReadingStore._TIME.pack_into(self._mm, self._times_at + 8 * head, ts)
+        ReadingStore._CHANNEL.pack_into(
+            self._mm, self._channels_at + 2 * head, self._channel_id(name))
+        # only move the head once the reading is complete
+        ReadingStore._HEADER.pack_into(
+            self._mm, 0, ReadingStore.MAGIC, capacity,
+            (head + 1) % capacity, min(count + 1, capacity))
+
+    def append_state(self, state):
+        """Append the readings of every device and module that has reported
+        since the last time.  Call with the state lock held."""
+        for rec in state.records:
+            ts = rec.get('time_utc')
+            if not ts or self._last_seen.get((rec.id, rec.type)) == ts:
+                continue
+            self._last_seen[(rec.id, rec.type)] = ts
+            for n, value in rec.items():
+                if (n in ReadingStore.FIELDS and
+                        isinstance(value, (int, float)) and
+                        not isinstance(value, bool)):
+                    self.append(ts, "%s.%s.%s" % (rec.id, rec.type, n), value)
+
+    def _matching(self, pattern):
+        """Return the ids of the channels that match a sensor map pattern"""
+        pparts = pattern.split('.')
+        if len(pparts) != 3:
+            return set()
+        if self._read_only:
+            self._load_channels()  # the writer may have added some
+        ids = set()
+        for i, name in enumerate(self._names):
+            nparts = name.rsplit('.', 2)
+            if all(StationState._part_match(p, x)
+                   for p, x in zip(pparts, nparts)):
+                ids.add(i)
+        return ids
+
+    def _scan(self):
+        """Yield (index, timestamp, channel) from newest to oldest"""
+        _, capacity, head, count = ReadingStore._HEADER.unpack_from(self._mm, 0)
+        for i in range(count):
+            idx = (head - 1 - i) % capacity
+            yield (idx,
+                   ReadingStore._TIME.unpack_from(
+                       self._mm, self._times_at + 8 * idx)[0],
+                   ReadingStore._CHANNEL.unpack_from(
+                       self._mm, self._channels_at + 2 * idx)[0])
+
+    def _value(self, idx):
+        return ReadingStore._VALUE.unpack_from(
+            self._mm, ReadingStore._HEADER_SIZE + 8 * idx)[0]
+
+    def latest(self, pattern):
+        """Return {channel: (timestamp, value)} with the latest reading of
+        every channel that matches the pattern."""
+        wanted = self._matching(pattern)
+        found = dict()
+        for idx, ts, chan in self._scan():
+            if not wanted:
+                break
+            if chan in wanted:
+                wanted.discard(chan)
+                found[self._names[chan]] = (ts, self._value(idx))
+        return found
+
+    def stats(self, pattern, since, until=None):
+        """Return {channel: (min, max, mean, count)} over the readings of
+        every channel that matches the pattern with since <= time <=
+        until."""
+        wanted = self._matching(pattern)
+        if until is None:
+            until = time.time()
+        acc = dict()
+        for idx, ts, chan in self._scan():
+            if ts < since - ReadingStore.SLACK:
+                break
+            if chan not in wanted or ts < since or ts > until:
+                continue
+            value = self._value(idx)
+            if chan in acc:
+                lo, hi, total, count = acc[chan]
+                acc[chan] = (min(lo, value), max(hi, value),
+                             total + value, count + 1)
+            else:
+                acc[chan] = (value, value, value, 1)
+        return dict((self._names[c], (lo, hi, total / count, count))
+                    for c, (lo, hi, total, count) in acc.items())
+
+
+class SharedPoller(object):
+    """Poll the netatmo servers on behalf of every weewx instance on a host.
+
+    The poller owns the account tokens and runs a single CloudClient.  After
+    each poll it publishes a snapshot of the station state, as one line of
+    json, to every subscriber connected to a unix domain socket.  A new
+    subscriber is sent the latest snapshot as soon as it connects.  No
+    sensor map is applied, since each subscriber applies its own.
+    """
+
+    DEFAULT_SOCKET = '/var/run/weewx-netatmo.sock'
+
+    def __init__(self, socket_path, client):
+        self._socket_path = socket_path
+        self._client = client
+        self._subscribers = []
+        self._last_msg = None
+        self._lock = threading.Lock()
+        self._sock = None
+        # lets subscribers tell a restarted poller from a repeated message
+        self._started = time.time()
+
+    def run(self):
+        """Publish every poll until interrupted."""
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self._socket_path)
+        self._sock.listen(5)
+        loginf("publishing to %s" % self._socket_path)
+        t = threading.Thread(target=self._accept, name='netatmo-shared')
+        t.daemon = True
+        t.start()
+        self._client.startup()
+        try:
+            while True:
+                try:
+                    state = self._client.queue.get(True, 10)
+                except Queue.Empty:
+                    continue
+                with state.lock:
+                    msg = json.dumps({'started': self._started,
+                                      'generation': state.generation,
+                                      'records': state.snapshot()})
+                self._publish((msg + '\n').encode('utf-8'))
+        finally:
+            self._client.shutdown()
+            self._sock.close()
+            os.unlink(self._socket_path)
+
+    def _accept(self):
+        while True:
+            conn, _ = self._sock.accept()
+            conn.settimeout(5)
+            logdbg("new subscriber")
+            with self._lock:
+                if self._last_msg is not None:
+                    try:
+                        conn.sendall(self._last_msg)
+                    except socket.error as e:
+                        logerr("failed to send to new subscriber: %s" % e)
+                        conn.close()
+                        continue
+                self._subscribers.append(conn)
+
+    def _publish(self, msg):
+        with self._lock:
+            self._last_msg = msg
+            for conn in list(self._subscribers):
+                try:
+                    conn.sendall(msg)
+                except socket.error as e:
+                    logdbg("dropping subscriber: %s" % e)
+                    conn.close()
+                    self._subscribers.remove(conn)
+            logdbg("published to %d subscribers" % len(self._subscribers))
+
+
+class SharedClient(Collector):
+    """Subscribe to a SharedPoller.  Load each snapshot into the station
+    state and put the state on the queue."""
+
+    def __init__(self, socket_path, retry_wait=10, sensor_map=None):
+        self._socket_path = socket_path
+        self._retry_wait = retry_wait
+        self._state = StationState(sensor_map)
+        self._thread = None
+        self._collect_data = False
+        self._last_generation = None
+
+    def collect_data(self):
+        """Stay connected to the poller until it is time to quit."""
+        while self._collect_data:
+            sock = None
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(1)
+                sock.connect(self._socket_path)
+                loginf("connected to %s" % self._socket_path)
+                self._read_messages(sock)
+            except (socket.error, ValueError, KeyError, TypeError) as e:
+                # a bad message means the stream can no longer be trusted,
+                # so drop the connection and start over
+                logerr("lost connection to %s: %s" % (self._socket_path, e))
+                logdbg("waiting %s seconds before retry" % self._retry_wait)
+                for _ in range(self._retry_wait):
+                    if not self._collect_data:
+                        break
+                    time.sleep(1)
+            finally:
+                if sock is not None:
+                    sock.close()
+
+    def _read_messages(self, sock):
+        buf = b''
+        while self._collect_data:
+            try:
+                chunk = sock.recv(65536)
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise socket.error("closed by poller")
+            buf += chunk
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                msg = json.loads(line.decode('utf-8'))
+                generation = (msg['started'], msg['generation'])
+                if generation == self._last_generation:
+                    continue  # sent again after a reconnect
+                self._last_generation = generation
+                self._state.load(msg['records'])
+                Collector.queue.put(self._state)
+
+    def startup(self):
+        """Start a thread that reads data from the shared poller."""
+        self._thread = CloudClient.CollectorThread(self)
+        self._thread.name = 'netatmo-shared'
+        self._collect_data = True
+        self._thread.start()
+
+    def shutdown(self):
+        """Tell the thread to stop, then wait for it to finish."""
+        if self._thread:
+            self._collect_data = False
+            self._thread.join()
+            self._thread = None
+
+
 class PacketSniffer(Collector):
     """listen for incoming packets then parse them.  put result on queue."""
 
@@ -673,6 +1415,681 @@ class PacketSniffer(Collector):
             return pkt
 
 
+class RateLimiter(object):
+    """Block callers so that no more than count requests are made in any
+    period seconds, for each (count, period) in limits.  Safe to share
+    between threads."""
+
+    # netatmo allows 50 requests every 10 seconds and 500 every hour
+    NETATMO_LIMITS = ((50, 10), (500, 3600))
+
+    def __init__(self, limits):
+        self._limits = sorted(limits, key=lambda x: x[1])
+        self._times = []
+        self._lock = threading.Lock()
+
+    def wait(self, share=1.0):
+        """Block until a request may be made.  A caller with a share less
+        than 1 only gets that fraction of each limit, which leaves the rest
+        for callers that matter more."""
+        while True:
+            with self._lock:
+                now = time.time()
+                delay = 0
+                for count, period in self._limits:
+                    count = max(1, int(count * share))
+                    idx = bisect.bisect_right(self._times, now - period)
+                    if len(self._times) - idx >= count:
+                        # wait until the oldest request in the window expires
+                        expires = self._times[len(self._times) - count] + period
+                        delay = max(delay, expires - now)
+                if delay <= 0:
+                    self._times.append(now)
+                    # forget anything older than the longest period
+                    idx = bisect.bisect_right(
+                        self._times, now - self._limits[-1][1])
+                    del self._times[:idx]
+                    return
+            time.sleep(delay)
+
+
+class HistoryExporter(object):
+    """Export the measurement history of every device and module on the
+    account by paging getmeasure, then stream the rows into a writer.
+
+    Each device or module is a channel.  Channels are paged in parallel by
+    a pool of threads that share one rate limiter, while the rows are
+    written by the calling thread as the pages arrive, so at most a few
+    pages are held in memory at any time.  The writer records the last
+    timestamp written for each channel along with the rows, so an export
+    that is interrupted picks up where it left off when it is run again.
+    """
+
+    # measurement types that getmeasure supports for each module type
+    MEASURE_TYPES = {
+        'NAMain': ('Temperature', 'Humidity', 'CO2', 'Noise', 'Pressure'),
+        'NAModule1': ('Temperature', 'Humidity'),
+        'NAModule2': ('WindStrength', 'WindAngle', 'GustStrength',
+                      'GustAngle'),
+        'NAModule3': ('Rain',),
+        'NAModule4': ('Temperature', 'Humidity', 'CO2')}
+    # every measurement type, in the order used for columns
+    ALL_TYPES = ('Temperature', 'Humidity', 'CO2', 'Noise', 'Pressure',
+                 'WindStrength', 'WindAngle', 'GustStrength', 'GustAngle',
+                 'Rain')
+    # most values that getmeasure will return in a single response
+    PAGE_SIZE = 1024
+
+    def __init__(self, auth, writer, date_begin, date_end, threads=4,
+                 max_tries=5, retry_wait=10):
+        self._auth = auth
+        self._writer = writer
+        self._date_begin = int(date_begin)
+        self._date_end = int(date_end)
+        self._threads = threads
+        self._failed = dict()
+        self._max_tries = max_tries
+        self._retry_wait = retry_wait
+
+    @staticmethod
+    def channel_key(device_id, module_id):
+        return "%s/%s" % (device_id, module_id or device_id)
+
+    @staticmethod
+    def get_channels(raw_data):
+        """Return (device_id, module_id, module_type) for every device and
+        module that has measurements we know how to get.  module_id is None
+        for the device itself."""
+        channels = []
+        for d in raw_data['devices']:
+            if d['type'] in HistoryExporter.MEASURE_TYPES:
+                channels.append((d['_id'], None, d['type']))
+            for m in d.get('modules', []):
+                if m['type'] in HistoryExporter.MEASURE_TYPES:
+                    channels.append((d['_id'], m['_id'], m['type']))
+        return channels
+
+    def run(self, channels):
+        """Export every channel that the writer wants.  Return the number of
+        rows written and {channel key: error} for the channels that could
+        not be finished."""
+        channels = [c for c in channels if self._writer.wants(c)]
+        progress = self._writer.progress()
+        work = Queue.Queue()
+        for c in channels:
+            work.put(c)
+        # bound the number of pages waiting to be written
+        pages = Queue.Queue(maxsize=2 * self._threads)
+        self._failed = dict()
+        threads = []
+        for i in range(min(self._threads, len(channels))):
+            t = threading.Thread(target=self._fetch_channels,
+                                 args=(work, pages, progress),
+                                 name='netatmo-export-%d' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        total = 0
+        done = 0
+        while done < len(threads):
+            page = pages.get()
+            if page is None:
+                done += 1
+                continue
+            channel, rows = page
+            self._writer.write(channel, rows)
+            total += len(rows)
+            loginf("wrote %d rows for %s up to %s" %
+                   (len(rows), self.channel_key(channel[0], channel[1]),
+                    rows[-1][0]))
+        self._writer.close()
+        return total, self._failed
+
+    def _fetch_channels(self, work, pages, progress):
+        try:
+            while True:
+                try:
+                    channel = work.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    self._fetch_channel(channel, pages, progress)
+                except Exception as e:
+                    key = self.channel_key(channel[0], channel[1])
+                    logerr("export of %s stopped: %s" % (key, e))
+                    self._failed[key] = e
+        finally:
+            pages.put(None)
+
+    def _fetch_channel(self, channel, pages, progress):
+        device_id, module_id, module_type = channel
+        types = HistoryExporter.MEASURE_TYPES[module_type]
+        last = progress.get(self.channel_key(device_id, module_id), 0)
+        begin = max(self._date_begin, last + 1)
+        while begin <= self._date_end:
+            body = self._get_measure(device_id, module_id, types, begin)
+            if not body:
+                break
+            rows = []
+            for ts in sorted(int(x) for x in body):
+                values = dict(zip(types, body[str(ts)]))
+                rows.append((ts, values))
+            pages.put((channel, rows))
+            begin = rows[-1][0] + 1
+
+    def _get_measure(self, device_id, module_id, types, date_begin):
+        params = {
+            'device_id': device_id,
+            'scale': 'max',
+            'type': ','.join(types),
+            'date_begin': date_begin,
+            'date_end': self._date_end,
+            'limit': HistoryExporter.PAGE_SIZE,
+            'optimize': 'false',
+            'real_time': 'true'}
+        if module_id:
+            params['module_id'] = module_id
+        for tries in range(self._max_tries):
+            self._auth.limiter.wait()
+            try:
+                headers = {"Authorization": "Bearer " + self._auth.access_token}
+                resp = CloudClient.post_request(
+                    CloudClient.GETM_URL, params, headers=headers)
+                return resp['body']
+            except (socket.error, socket.timeout,
+                    urllib.error.HTTPError if pvers == 3 else urllib2.HTTPError,
+                    urllib.error.URLError if pvers == 3 else urllib2.URLError) as e:
+                # back off harder each time, in case this is the rate limit
+                wait = self._retry_wait * 2 ** tries
+                logerr("failed attempt %s of %s to get measurements: %s" %
+                       (tries + 1, self._max_tries, e))
+                logdbg("waiting %s seconds before retry" % wait)
+                time.sleep(wait)
+        raise IOError("failed to get measurements after %d attempts" %
+                      self._max_tries)
+
+    class CSVWriter(object):
+        """One line per measurement with a column for every type.  The
+        progress is kept next to the file in <filename>.progress, and is
+        saved after the rows are flushed, so an interruption at the wrong
+        moment can repeat at most one page of rows."""
+
+        HEADER = ('dateTime', 'device_id', 'module_id', 'module_type',
+                  'Temperature', 'Humidity', 'CO2', 'Noise', 'Pressure',
+                  'WindStrength', 'WindAngle', 'GustStrength', 'GustAngle',
+                  'Rain')
+
+        def __init__(self, filename):
+            import csv
+            self._progress_file = filename + '.progress'
+            self._progress = dict()
+            if os.path.exists(self._progress_file):
+                with open(self._progress_file, 'r') as f:
+                    self._progress = json.load(f)
+            exists = os.path.exists(filename) and os.path.getsize(filename)
+            self._file = open(filename, 'a')
+            self._csv = csv.writer(self._file)
+            if not exists:
+                self._csv.writerow(HistoryExporter.CSVWriter.HEADER)
+
+        def wants(self, channel):
+            return True
+
+        def progress(self):
+            return dict(self._progress)
+
+        def write(self, channel, rows):
+            device_id, module_id, module_type = channel
+            for ts, values in rows:
+                self._csv.writerow(
+                    [ts, device_id, module_id or device_id, module_type] +
+                    [values.get(x) for x in HistoryExporter.ALL_TYPES])
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            key = HistoryExporter.channel_key(device_id, module_id)
+            self._progress[key] = rows[-1][0]
+            tmp = self._progress_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._progress, f)
+            os.rename(tmp, self._progress_file)
+
+        def close(self):
+            self._file.close()
+
+    class SQLiteWriter(object):
+        """One row per measurement in a table called measure, keyed on the
+        module and timestamp.  The progress is kept in the same database
+        and committed with the rows."""
+
+        def __init__(self, filename):
+            import sqlite3
+            self._conn = sqlite3.connect(filename)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS export_progress "
+                "(channel TEXT PRIMARY KEY, last INTEGER NOT NULL)")
+            self._create_table()
+            self._conn.commit()
+
+        def _create_table(self):
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS measure "
+                "(dateTime INTEGER NOT NULL, device_id TEXT NOT NULL, "
+                "module_id TEXT NOT NULL, module_type TEXT NOT NULL, %s, "
+                "PRIMARY KEY (module_id, dateTime))" %
+                ', '.join('%s REAL' % x for x in HistoryExporter.ALL_TYPES))
+
+        def wants(self, channel):
+            return True
+
+        def progress(self):
+            return dict(self._conn.execute(
+                "SELECT channel, last FROM export_progress"))
+
+        def write(self, channel, rows):
+            device_id, module_id, module_type = channel
+            columns = HistoryExporter.ALL_TYPES
+            sql = ("INSERT OR REPLACE INTO measure (dateTime, device_id, "
+                   "module_id, module_type, %s) VALUES (?, ?, ?, ?, %s)" %
+                   (', '.join(columns), ', '.join('?' * len(columns))))
+            self._conn.executemany(sql, (
+                [ts, device_id, module_id or device_id, module_type] +
+                [values.get(x) for x in columns] for ts, values in rows))
+            self._save_progress(channel, rows)
+
+        def _save_progress(self, channel, rows):
+            self._conn.execute(
+                "INSERT OR REPLACE INTO export_progress (channel, last) "
+                "VALUES (?, ?)",
+                (HistoryExporter.channel_key(channel[0], channel[1]),
+                 rows[-1][0]))
+            self._conn.commit()
+
+        def close(self):
+            self._conn.close()
+
+    class ArchiveWriter(SQLiteWriter):
+        """Write into a table with the weewx archive schema, one row per
+        archive interval, so that the database can be used directly by
+        weewx or merged into an existing weewx database.  Measurements are
+        mapped to archive columns using the sensor map, converted to
+        weewx.METRIC, and binned into the interval that ends at or after
+        the measurement.  Rain is summed over the interval, anything else
+        takes the last value.  Columns that the table does not have are
+        skipped.
+
+        As in the driver, each column comes from the first device or module
+        that matches its sensor map pattern, so with the default map only
+        the first device on the account and the first module of each type
+        are exported.  Map other modules by id to export them too."""
+
+        # getmeasure reports sea-level pressure, which weewx calls barometer
+        EXTRA_MAP = {'barometer': '*.NAMain.Pressure'}
+
+        def __init__(self, filename, channels, sensor_map=None, interval=300):
+            self._interval = interval
+            if sensor_map is None:
+                sensor_map = NetatmoDriver.DEFAULT_SENSOR_MAP
+            sensor_map = dict(sensor_map)
+            for name in HistoryExporter.ArchiveWriter.EXTRA_MAP:
+                sensor_map.setdefault(
+                    name, HistoryExporter.ArchiveWriter.EXTRA_MAP[name])
+            # (device or module id, type) to [(field, column)]
+            self._columns = dict()
+            for name in sorted(sensor_map):
+                pparts = sensor_map[name].split('.')
+                if len(pparts) != 3:
+                    continue
+                for device_id, module_id, module_type in channels:
+                    xid = module_id or device_id
+                    fields = [x for x in HistoryExporter.MEASURE_TYPES[module_type]
+                              if StationState._part_match(pparts[0], xid) and
+                              StationState._part_match(pparts[1], module_type) and
+                              StationState._part_match(pparts[2], x)]
+                    if fields:
+                        self._columns.setdefault((xid, module_type), []).append(
+                            (fields[0], name))
+                        break
+            super(HistoryExporter.ArchiveWriter, self).__init__(filename)
+
+        def wants(self, channel):
+            return (channel[1] or channel[0], channel[2]) in self._columns
+
+        def _create_table(self):
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS archive "
+                "(dateTime INTEGER NOT NULL UNIQUE PRIMARY KEY, "
+                "usUnits INTEGER NOT NULL, interval INTEGER NOT NULL, %s)" %
+                ', '.join('`%s` REAL' % x for x in sorted(
+                    set(col for v in self._columns.values() for _, col in v))))
+            existing = set(r[1] for r in self._conn.execute(
+                "PRAGMA table_info(archive)"))
+            for k in list(self._columns):
+                for x, col in list(self._columns[k]):
+                    if col not in existing:
+                        loginf("archive has no column %s, skipping %s.%s.%s" %
+                               (col, k[0], k[1], x))
+                        self._columns[k].remove((x, col))
+                if not self._columns[k]:
+                    del self._columns[k]
+
+        def write(self, channel, rows):
+            columns = self._columns.get((channel[1] or channel[0], channel[2]), [])
+            for ts, values in rows:
+                ts = -(-ts // self._interval) * self._interval
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO archive (dateTime, usUnits, "
+                    "interval) VALUES (?, ?, ?)",
+                    (ts, weewx.METRIC, self._interval // 60))
+                for x, col in columns:
+                    value = values.get(x)
+                    if value is None:
+                        continue
+                    if x == 'Rain':
+                        self._conn.execute(
+                            "UPDATE archive SET `%s` = COALESCE(`%s`, 0) + ? "
+                            "WHERE dateTime = ?" % (col, col),
+                            (CloudClient._cvt_rain(value, None), ts))
+                    else:
+                        self._conn.execute(
+                            "UPDATE archive SET `%s` = ? WHERE dateTime = ?"
+                            % col, (value, ts))
+            self._save_progress(channel, rows)
+
+
+class PublicDataClient(Collector):
+    """Poll the netatmo servers for the public stations in a bounding box.
+    Put aggregates of their readings on the queue.
+
+    The box is split into square tiles that are fetched in parallel.  A
+    tile whose response cannot be decoded is fetched as smaller pieces from
+    then on.  Each
+    station belongs to the tile that contains its location, so a station
+    that is returned for more than one tile is only counted once.  A tile
+    is only fetched again once its stations are due to have reported since
+    the last fetch, and tiles with no stations are fetched less and less
+    often.
+
+    The aggregates are in the station state as a record for the whole box,
+    with id 'area', and a record for each tile, with id 'tile_<row>_<col>'
+    counting rows from the south and columns from the west.  All of them
+    have type NAPublic, so a sensor map entry such as
+
+      regionTemp = area.NAPublic.Temperature
+
+    maps the mean temperature of the box.  Each measurement has a mean
+    value, plus _min and _max, except for angles, which only have a mean.
+    """
+
+    # netatmo names of public measurements and what we call them
+    MEASURES = {
+        'temperature': 'Temperature',
+        'humidity': 'Humidity',
+        'pressure': 'Pressure',
+        'rain_live': 'Rain',
+        'rain_60min': 'sum_rain_1',
+        'rain_24h': 'sum_rain_24',
+        'wind_strength': 'WindStrength',
+        'wind_angle': 'WindAngle',
+        'gust_strength': 'GustStrength',
+        'gust_angle': 'GustAngle'}
+    ANGLES = ('WindAngle', 'GustAngle')
+    # how often a public station is expected to report
+    STATION_INTERVAL = 600  # seconds
+    # longest wait before fetching a tile that had no stations
+    MAX_EMPTY_WAIT = 21600  # seconds
+    # most times a tile is split when its responses cannot be decoded
+    MAX_SPLITS = 3
+    # fetches of a split tile before trying it in bigger pieces again
+    SPLIT_HOLD = 6
+    # fraction of the request limits that public data may use, so that it
+    # never starves the station poll sharing the same tokens
+    LIMIT_SHARE = 0.5
+
+    def __init__(self, auth, lat_ne, lon_ne, lat_sw, lon_sw, tile_size=0.1,
+                 threads=4, poll_interval=600, max_tries=3, retry_wait=30,
+                 sensor_map=None):
+        self._auth = auth
+        self._lat_sw = lat_sw
+        self._lon_sw = lon_sw
+        self._lat_ne = lat_ne
+        self._lon_ne = lon_ne
+        self._tile_size = tile_size
+        self._rows = max(1, int(math.ceil((lat_ne - lat_sw) / tile_size)))
+        self._cols = max(1, int(math.ceil((lon_ne - lon_sw) / tile_size)))
+        self._threads = threads
+        self._poll_interval = poll_interval
+        self._max_tries = max_tries
+        self._retry_wait = retry_wait
+        self._state = StationState(sensor_map)
+        # (row, col) to the tile's stations and when to fetch it again
+        self._tiles = dict(((r, c), PublicDataClient.Tile())
+                           for r in range(self._rows)
+                           for c in range(self._cols))
+        self._thread = None
+        self._collect_data = False
+        loginf("public data from %d tiles" % len(self._tiles))
+
+    class Tile(object):
+        __slots__ = ('stations', 'due', 'empty', 'splits', 'held')
+
+        def __init__(self):
+            self.stations = dict()  # station id to {field: value}
+            self.due = 0
+            self.empty = 0
+            self.splits = 0  # fetched as 4**splits pieces
+            self.held = 0  # fetches since splits last changed
+
+    def collect_data(self):
+        """Loop forever, wake up periodically to see if it is time to quit."""
+        last_poll = 0
+        while self._collect_data:
+            now = int(time.time())
+            if now - last_poll > self._poll_interval:
+                try:
+                    self.get_data(now)
+                except Exception as e:
+                    logerr("exception in netatmo-public: %s" % e)
+                    weeutil.weeutil.log_traceback('*** ', syslog.LOG_DEBUG)
+                last_poll = now
+                logdbg('next public update in %s seconds' % self._poll_interval)
+            time.sleep(1)
+
+    def get_data(self, now):
+        """Fetch the tiles that are due, then aggregate every tile and put
+        the state on the queue"""
+        due = Queue.Queue()
+        for key in self._tiles:
+            if self._tiles[key].due <= now:
+                due.put(key)
+        logdbg("fetching %d of %d tiles" % (due.qsize(), len(self._tiles)))
+        threads = []
+        for i in range(min(self._threads, due.qsize())):
+            t = threading.Thread(target=self._fetch_tiles, args=(due, now),
+                                 name='netatmo-public-%d' % i)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        with self._state.lock:
+            self._state.begin_update()
+            everything = []
+            for (r, c) in sorted(self._tiles):
+                stations = list(self._tiles[(r, c)].stations.values())
+                everything.extend(stations)
+                rec = self._state.record('tile_%d_%d' % (r, c), 'NAPublic')
+                if rec is not None:
+                    PublicDataClient.aggregate(stations, rec)
+            rec = self._state.record('area', 'NAPublic')
+            if rec is not None:
+                PublicDataClient.aggregate(everything, rec)
+            self._state.end_update()
+        Collector.queue.put(self._state)
+
+    def _fetch_tiles(self, due, now):
+        while True:
+            try:
+                key = due.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                self._fetch_tile(key, now)
+            except Exception as e:
+                logerr("failed to get public data for tile %s,%s: %s" %
+                       (key[0], key[1], e))
+
+    def _fetch_tile(self, key, now):
+        tile = self._tiles[key]
+        body = None
+        while body is None:
+            try:
+                body = self._fetch_area(key, tile.splits)
+            except ValueError as e:
+                # the response could not be decoded, most likely because it
+                # was cut short, so ask for smaller pieces of the tile
+                if tile.splits >= PublicDataClient.MAX_SPLITS:
+                    raise
+                tile.splits += 1
+                tile.held = 0
+                loginf("splitting tile %s,%s into %d pieces: %s" %
+                       (key[0], key[1], 4 ** tile.splits, e))
+            if body is False:
+                return
+        if tile.splits:
+            # stations come and go, so now and then see whether the tile
+            # decodes in bigger pieces again
+            tile.held += 1
+            if tile.held >= PublicDataClient.SPLIT_HOLD:
+                tile.splits -= 1
+                tile.held = 0
+        stations = dict()
+        newest = 0
+        for stn in body:
+            if self._tile_of(stn['place']['location']) != key:
+                continue  # belongs to a neighbouring tile
+            data = PublicDataClient.extract_data(stn)
+            if data:
+                stations[stn['_id']] = data
+                newest = max(newest, data['time_utc'])
+        tile.stations = stations
+        if stations:
+            tile.empty = 0
+            # nothing new until the latest station reports again
+            tile.due = max(newest + PublicDataClient.STATION_INTERVAL, now)
+        else:
+            tile.empty += 1
+            tile.due = now + min(self._poll_interval * 2 ** tile.empty,
+                                 PublicDataClient.MAX_EMPTY_WAIT)
+
+    def _fetch_area(self, key, splits):
+        """Return the stations in a tile, fetched as 4**splits pieces.
+        Return False if the servers could not be reached."""
+        r, c = key
+        pieces = 2 ** splits
+        size = self._tile_size / pieces
+        body = []
+        for i in range(pieces):
+            for j in range(pieces):
+                lat_sw = self._lat_sw + r * self._tile_size + i * size
+                lon_sw = self._lon_sw + c * self._tile_size + j * size
+                params = {
+                    'lat_sw': lat_sw,
+                    'lon_sw': lon_sw,
+                    'lat_ne': min(lat_sw + size, self._lat_ne),
+                    'lon_ne': min(lon_sw + size, self._lon_ne),
+                    'filter': 'true'}
+                for tries in range(self._max_tries):
+                    self._auth.limiter.wait(PublicDataClient.LIMIT_SHARE)
+                    try:
+                        headers = {"Authorization": "Bearer " + self._auth.access_token}
+                        resp = CloudClient.post_request(
+                            CloudClient.PUBLIC_URL, params, headers=headers,
+                            max_size=None)
+                        break
+                    except (socket.error, socket.timeout,
+                            urllib.error.HTTPError if pvers == 3 else urllib2.HTTPError,
+                            urllib.error.URLError if pvers == 3 else urllib2.URLError) as e:
+                        logerr("failed attempt %s of %s to get public data: %s" %
+                               (tries + 1, self._max_tries, e))
+                        time.sleep(self._retry_wait)
+                else:
+                    return False
+                body.extend(resp['body'])
+        return body
+
+    def _tile_of(self, location):
+        lon, lat = location[0], location[1]
+        if not (self._lat_sw <= lat <= self._lat_ne and
+                self._lon_sw <= lon <= self._lon_ne):
+            return None
+        r = min(int((lat - self._lat_sw) / self._tile_size), self._rows - 1)
+        c = min(int((lon - self._lon_sw) / self._tile_size), self._cols - 1)
+        return r, c
+
+    @staticmethod
+    def extract_data(stn):
+        """Flatten the measures of a public station into a dict, converting
+        to weewx.METRIC"""
+        data = dict()
+        newest = 0
+        for m in stn.get('measures', {}).values():
+            if 'res' in m:
+                # readings are keyed by time, values in the order of type
+                for ts in m['res']:
+                    newest = max(newest, int(ts))
+                    for name, value in zip(m['type'], m['res'][ts]):
+                        if name in PublicDataClient.MEASURES:
+                            data[PublicDataClient.MEASURES[name]] = value
+            else:
+                for name in m:
+                    if name in PublicDataClient.MEASURES:
+                        data[PublicDataClient.MEASURES[name]] = m[name]
+                    elif name.endswith('_timeutc'):
+                        newest = max(newest, int(m[name]))
+        for n in CloudClient.CONVERSIONS:
+            if data.get(n) is not None:
+                data[n] = getattr(CloudClient, CloudClient.CONVERSIONS[n])(
+                    data[n], None)
+        if data:
+            data['time_utc'] = newest
+        return data
+
+    @staticmethod
+    def aggregate(stations, rec):
+        """Reduce the readings of some stations into a record"""
+        rec.clear()
+        rec.set('stations', len(stations))
+        if not stations:
+            return
+        rec.set('time_utc', max(s['time_utc'] for s in stations))
+        for n in PublicDataClient.MEASURES.values():
+            values = [s[n] for s in stations if s.get(n) is not None]
+            if not values:
+                continue
+            if n in PublicDataClient.ANGLES:
+                x = sum(math.cos(math.radians(v)) for v in values)
+                y = sum(math.sin(math.radians(v)) for v in values)
+                rec.set(n, round(math.degrees(math.atan2(y, x)), 1) % 360)
+            else:
+                rec.set(n, sum(values) / float(len(values)))
+                rec.set(n + '_min', min(values))
+                rec.set(n + '_max', max(values))
+
+    def startup(self):
+        """Start a thread that collects public data from the netatmo
+        servers."""
+        self._thread = CloudClient.CollectorThread(self)
+        self._thread.name = 'netatmo-public'
+        self._collect_data = True
+        self._thread.start()
+
+    def shutdown(self):
+        """Tell the thread to stop, then wait for it to finish."""
+        if self._thread:
+            self._collect_data = False
+            self._thread.join()
+            self._thread = None
+
+
 # To test this driver, do the following:
 #   PYTHONPATH=bin python user/netatmo.py
 if __name__ == "__main__":
@@ -691,6 +2108,14 @@ if __name__ == "__main__":
                           help='run the driver in packet sniff mode')
         parser.add_option('--run-cloud-driver', dest='tc', action='store_true',
                           help='run the driver in cloud client mode')
+        parser.add_option('--run-shared-poller', dest='sp', action='store_true',
+                          help='poll the cloud for every weewx on this host')
+        parser.add_option('--socket', dest='socket_path', metavar='PATH',
+                          default=SharedPoller.DEFAULT_SOCKET,
+                          help='socket for the shared poller')
+        parser.add_option('--poll-interval', dest='poll_interval', type='int',
+                          default=300, metavar='SECONDS',
+                          help='how often the shared poller polls the cloud')
         parser.add_option('--test-parse', dest='tp', metavar='FILENAME',
                           help='test the tcp packet parser')
         parser.add_option('--tokens_persistence_file', dest='tokens_persistence_file',
@@ -704,21 +2129,63 @@ if __name__ == "__main__":
                           help='get formatted station data from cloud')
         parser.add_option('--get-json-data', dest='jdata', action='store_true',
                           help='get all cloud data as json response')
+        parser.add_option('--export-history', dest='export', metavar='FILENAME',
+                          help='export measurement history from cloud')
+        parser.add_option('--export-format', dest='export_format',
+                          type='choice', choices=['csv', 'sqlite', 'weewx'],
+                          default='csv',
+                          help='csv, sqlite, or weewx archive (default csv)')
+        parser.add_option('--date-begin', dest='date_begin', metavar='YYYY-MM-DD',
+                          help='start of history export')
+        parser.add_option('--date-end', dest='date_end', metavar='YYYY-MM-DD',
+                          help='end of history export (default now)')
+        parser.add_option('--config', dest='config', metavar='CONFIG_FILE',
+                          help='weewx configuration with the sensor map for '
+                          'the weewx export format')
+        parser.add_option('--export-threads', dest='export_threads', type='int',
+                          default=4, metavar='N',
+                          help='number of parallel history requests')
+        parser.add_option('--query-store', dest='qstore', metavar='FILENAME',
+                          help='query the ring buffer of recent readings')
+        parser.add_option('--pattern', dest='pattern', default='*.*.*',
+                          metavar='ID.TYPE.FIELD',
+                          help='channels to query, as in the sensor map')
+        parser.add_option('--hours', dest='hours', type='float', metavar='N',
+                          help='min/max/mean over the last N hours instead '
+                          'of the latest readings')
+        parser.add_option('--bench-decode', dest='bench', metavar='FILENAME',
+                          help='time decoding of a saved --get-json-data response')
+        parser.add_option('--bench-count', dest='bench_count', type='int',
+                          default=1000, metavar='N',
+                          help='number of decodes per decoder')
         (opts, args) = parser.parse_args()
 
         if opts.debug:
+            global DEBUG
+            DEBUG = True
             syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
 
         if opts.ts:
             run_packet_driver()
         if opts.tc:
             run_cloud_driver(opts.tokens_persistence_file, opts.ci, opts.cs)
+        if opts.sp:
+            run_shared_poller(opts.tokens_persistence_file, opts.ci, opts.cs,
+                              opts.socket_path, opts.poll_interval)
         if opts.tp:
             test_parse(options.tp)
         if opts.sdata:
             get_station_data(opts.tokens_persistence_file, opts.ci, opts.cs)
         if opts.jdata:
             get_json_data(opts.tokens_persistence_file, opts.ci, opts.cs)
+        if opts.bench:
+            bench_decode(opts.bench, opts.bench_count)
+        if opts.qstore:
+            query_store(opts.qstore, opts.pattern, opts.hours)
+        if opts.export:
+            export_history(opts.tokens_persistence_file, opts.ci, opts.cs,
+                           opts.export, opts.export_format, opts.date_begin,
+                           opts.date_end, opts.export_threads, opts.config)
 
 
     def run_sniff_driver():
@@ -741,6 +2208,16 @@ if __name__ == "__main__":
             driver.closePort()
 
 
+    def run_shared_poller(tokens_persistence_file, c_id, c_secret,
+                          socket_path, poll_interval):
+        client = CloudClient(tokens_persistence_file, c_id, c_secret,
+                             poll_interval=poll_interval)
+        try:
+            SharedPoller(socket_path, client).run()
+        except KeyboardInterrupt:
+            pass
+
+
     def get_station_data(tokens_persistence_file, c_id, c_secret):
         auth = CloudClient.GrantTypeAuth(tokens_persistence_file, c_id, c_secret)
         sd = CloudClient.StationData(auth)
@@ -755,6 +2232,94 @@ if __name__ == "__main__":
         print(json.dumps(reply, sort_keys=True, indent=2))
 
 
+    def export_history(tokens_persistence_file, c_id, c_secret, filename,
+                       fmt, date_begin, date_end, threads, config_path):
+        if not date_begin:
+            print("--export-history requires --date-begin")
+            return
+        date_begin = time.mktime(time.strptime(date_begin, '%Y-%m-%d'))
+        if date_end:
+            date_end = time.mktime(time.strptime(date_end, '%Y-%m-%d'))
+        else:
+            date_end = time.time()
+        auth = CloudClient.GrantTypeAuth(tokens_persistence_file, c_id, c_secret)
+        sd = CloudClient.StationData(auth)
+        channels = HistoryExporter.get_channels(sd.get_data())
+        if fmt == 'sqlite':
+            writer = HistoryExporter.SQLiteWriter(filename)
+        elif fmt == 'weewx':
+            sensor_map = dict(NetatmoDriver.DEFAULT_SENSOR_MAP)
+            if config_path:
+                # use the same sensor map as the driver
+                import configobj
+                config_dict = configobj.ConfigObj(config_path, file_error=True)
+                sensor_map.update(config_dict.get(DRIVER_NAME, {}).get('sensor_map', {}))
+            writer = HistoryExporter.ArchiveWriter(filename, channels,
+                                                   sensor_map=sensor_map)
+        else:
+            writer = HistoryExporter.CSVWriter(filename)
+        print("exporting %d devices and modules to %s" % (len(channels), filename))
+        exporter = HistoryExporter(auth, writer, date_begin, date_end,
+                                   threads=threads)
+        total, failed = exporter.run(channels)
+        print("wrote %d rows" % total)
+        if failed:
+            for key in sorted(failed):
+                print("export of %s stopped: %s" % (key, failed[key]))
+            print("the export is incomplete, run the same command again to resume")
+            sys.exit(1)
+
+
+    def query_store(filename, pattern, hours):
+        store = ReadingStore(filename, read_only=True)
+        if hours:
+            stats = store.stats(pattern, time.time() - hours * 3600)
+            for name in sorted(stats):
+                print("%s min=%s max=%s mean=%.2f count=%d" %
+                      ((name,) + stats[name]))
+        else:
+            latest = store.latest(pattern)
+            for name in sorted(latest):
+                print("%s %s %s" % (name, weeutil.weeutil.timestamp_to_string(
+                    latest[name][0]), latest[name][1]))
+        store.close()
+
+
+    def bench_decode(filename, count):
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        # what post_request and StationData.get_data used to do
+        def old_decode(x):
+            resp = json.loads(x)
+            return dict(resp['body'])
+        candidates = [('json (old)', old_decode),
+                      ('json', CloudClient.ResponseDecoder(json.loads).decode),
+                      ('json (pruned)', CloudClient.ResponseDecoder(
+                          json.loads, CloudClient.STATIONS_KEYS).decode)]
+        for name in sorted(JSON_DECODERS):
+            if name != 'json':
+                candidates.append(
+                    (name, CloudClient.ResponseDecoder(JSON_DECODERS[name]).decode))
+        print("decoding %d bytes %d times" % (len(raw), count))
+        for name, decode in candidates:
+            start = time.time()
+            for _ in range(count):
+                decode(raw)
+            elapsed = (time.time() - start) / count
+            peak = ''
+            if tracemalloc:
+                tracemalloc.start()
+                obj = decode(raw)
+                peak = ' peak %d KB' % (tracemalloc.get_traced_memory()[1] // 1024)
+                tracemalloc.stop()
+                del obj
+            print("%-20s %8.1f us%s" % (name, elapsed * 1e6, peak))
+
+
     def test_parse(filename):
         lines = []
         with open(filename, "r") as f: